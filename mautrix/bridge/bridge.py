@@ -16,6 +16,7 @@ from mautrix import __version__ as __mautrix_version__
 
 from ..util.program import Program
 from ..util.bridge_state import BridgeState, BridgeStateEvent, GlobalBridgeState
+from ..util.message_send_checkpoint import close_checkpoint_session
 from .commands.manhole import ManholeState
 from .config import BaseBridgeConfig
 from .matrix import BaseMatrixHandler
@@ -177,6 +178,7 @@ class Bridge(Program, ABC):
             self.manhole = None
         await self.az.stop()
         await super().stop()
+        await close_checkpoint_session()
         if self.matrix.e2ee:
             await self.matrix.e2ee.stop()
 
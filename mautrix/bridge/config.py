@@ -86,6 +86,7 @@ class BaseBridgeConfig(BaseFileConfig, BaseValidatableConfig, ABC):
         copy("bridge.management_room_text.welcome_unconnected")
         copy("bridge.management_room_text.additional_help")
         copy("bridge.management_room_multiple_messages")
+        copy("bridge.management_room_parallel_messages")
 
         copy("manhole.enabled")
         copy("manhole.path")
@@ -3,7 +3,7 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
-from typing import Tuple, Optional, Union, TYPE_CHECKING
+from typing import Tuple, Optional, Union, Dict, Callable, Awaitable, TYPE_CHECKING
 import logging
 import asyncio
 import time
@@ -20,10 +20,12 @@ from mautrix.util.logging import TraceLogger
 from mautrix.util.opt_prometheus import Histogram
 from mautrix.util.message_send_checkpoint import (
     CHECKPOINT_TYPES,
+    CheckpointSender,
     MessageSendCheckpoint,
     MessageSendCheckpointReportedBy,
     MessageSendCheckpointStatus,
     MessageSendCheckpointStep,
+    is_checkpoint_type,
 )
 
 from .commands import CommandProcessor
@@ -48,6 +50,14 @@ except ImportError:
 EVENT_TIME = Histogram("bridge_matrix_event", "Time spent processing Matrix events",
                        ["event_type"])
 
+# Encrypted events are excluded because they will be decrypted and handled as normal events.
+BRIDGE_CHECKPOINT_TYPES = CHECKPOINT_TYPES - {EventType.ROOM_ENCRYPTED}
+
+# Shared placeholders for member events without unsigned data or previous content.
+# These are only read from, never passed to handlers, so they must not be mutated.
+_EMPTY_UNSIGNED = StateUnsigned()
+_EMPTY_MEMBER_CONTENT = MemberStateEventContent()
+
 
 class BaseMatrixHandler:
     log: TraceLogger = logging.getLogger("mau.mx")
@@ -61,6 +71,18 @@ class BaseMatrixHandler:
     user_id_prefix: str
     user_id_suffix: str
 
+    _DM_CACHE_TTL: float = 60.0
+    _dm_cache: Dict[RoomID, Tuple[float, Tuple[bool, bool]]]
+    _dispatch: Dict[EventType, Callable[[Event], Awaitable[None]]]
+    _event_time_labels: Dict[EventType, Histogram]
+    _bot_mxid: UserID
+    _command_prefix: str
+    _command_prefix_len: int
+    _checkpoint_endpoint: Optional[str]
+    _checkpoints_enabled: bool
+    _checkpoint_overridden: bool
+    _welcome_html: Dict[str, str]
+
     def __init__(self, command_processor: Optional[CommandProcessor] = None,
                  bridge: Optional['Bridge'] = None) -> None:
         self.az = bridge.az
@@ -68,6 +90,22 @@ class BaseMatrixHandler:
         self.bridge = bridge
         self.commands = command_processor or CommandProcessor(bridge=bridge)
         self.media_config = MediaRepoConfig(upload_size=50 * 1024 * 1024)
+        self._dm_cache = {}
+        self._dispatch = {
+            EventType.ROOM_MEMBER: self._dispatch_member,
+            EventType.ROOM_MESSAGE: self._dispatch_message,
+            EventType.STICKER: self._dispatch_message,
+            EventType.ROOM_ENCRYPTED: self.handle_encrypted,
+            EventType.ROOM_ENCRYPTION: self.handle_encryption,
+        }
+        self._event_time_labels = {}
+        self._bot_mxid = self.az.bot_mxid
+        self._command_prefix = self.config["bridge.command_prefix"]
+        self._command_prefix_len = len(self._command_prefix)
+        self._checkpoint_endpoint = self.config["homeserver.message_send_checkpoint_endpoint"]
+        self._checkpoints_enabled = bool(self._checkpoint_endpoint)
+        self._checkpoint_overridden = (type(self).send_message_send_checkpoint
+                                       is not BaseMatrixHandler.send_message_send_checkpoint)
         self.az.matrix_event_handler(self.int_handle_event)
 
         self.e2ee = None
@@ -97,6 +135,13 @@ class BaseMatrixHandler:
             "bridge.management_room_multiple_messages",
             False,
         )
+        self.management_room_parallel_messages = self.config.get(
+            "bridge.management_room_parallel_messages",
+            False,
+        )
+        self._welcome_html = {text: markdown.render(text)
+                              for text in self.management_room_text.values()
+                              if isinstance(text, str)}
 
     async def wait_for_connection(self) -> None:
         self.log.info("Ensuring connectivity to homeserver")
@@ -128,20 +173,26 @@ class BaseMatrixHandler:
 
     async def init_as_bot(self) -> None:
         self.log.debug("Initializing appservice bot")
+        tasks = []
         displayname = self.config["appservice.bot_displayname"]
         if displayname:
-            try:
-                await self.az.intent.set_displayname(
-                    displayname if displayname != "remove" else "")
-            except Exception:
-                self.log.exception("Failed to set bot displayname")
-
+            tasks.append(self._set_bot_displayname(displayname))
         avatar = self.config["appservice.bot_avatar"]
         if avatar:
-            try:
-                await self.az.intent.set_avatar_url(avatar if avatar != "remove" else "")
-            except Exception:
-                self.log.exception("Failed to set bot avatar")
+            tasks.append(self._set_bot_avatar(avatar))
+        await asyncio.gather(*tasks)
+
+    async def _set_bot_displayname(self, displayname: str) -> None:
+        try:
+            await self.az.intent.set_displayname(displayname if displayname != "remove" else "")
+        except Exception:
+            self.log.exception("Failed to set bot displayname")
+
+    async def _set_bot_avatar(self, avatar: str) -> None:
+        try:
+            await self.az.intent.set_avatar_url(avatar if avatar != "remove" else "")
+        except Exception:
+            self.log.exception("Failed to set bot avatar")
 
     async def init_encryption(self) -> None:
         if self.e2ee:
@@ -263,14 +314,26 @@ class BaseMatrixHandler:
             cmd_prefix = self.commands.command_prefix
             welcome_messages.append(f"Use `{cmd_prefix} help` for help.")
 
-        if self.management_room_multiple_messages:
+        if self.management_room_multiple_messages and self.management_room_parallel_messages:
+            # Faster, but the messages may show up in any order
+            await asyncio.gather(*(self.az.intent.send_notice(room_id, text=m,
+                                                              html=self._render_welcome(m))
+                                   for m in welcome_messages))
+        elif self.management_room_multiple_messages:
             for m in welcome_messages:
-                await self.az.intent.send_notice(room_id, text=m, html=markdown.render(m))
+                await self.az.intent.send_notice(room_id, text=m, html=self._render_welcome(m))
         else:
             combined = "\n".join(welcome_messages)
-            combined_html = "".join(map(markdown.render, welcome_messages))
+            combined_html = "".join(map(self._render_welcome, welcome_messages))
             await self.az.intent.send_notice(room_id, text=combined, html=combined_html)
 
+    def _render_welcome(self, text: str) -> str:
+        try:
+            return self._welcome_html[text]
+        except KeyError:
+            html = self._welcome_html[text] = markdown.render(text)
+            return html
+
     async def int_handle_invite(self, room_id: RoomID, user_id: UserID, invited_by: UserID,
                                 event_id: EventID) -> None:
         self.log.debug(f"{invited_by} invited {user_id} to {room_id}")
@@ -293,17 +356,17 @@ class BaseMatrixHandler:
 
     def is_command(self, message: MessageEventContent) -> Tuple[bool, str]:
         text = message.body
-        prefix = self.config["bridge.command_prefix"]
-        is_command = text.startswith(prefix)
-        if is_command:
-            text = text[len(prefix) + 1:].lstrip()
-        return is_command, text
+        if text.startswith(self._command_prefix):
+            return True, text[self._command_prefix_len + 1:].lstrip()
+        return False, text
 
     async def handle_message(self, room_id: RoomID, user_id: UserID, message: MessageEventContent,
                              event_id: EventID) -> None:
         async def bail(error_text: str, step=MessageSendCheckpointStep.REMOTE) -> None:
             self.log.debug(error_text)
-            await MessageSendCheckpoint(
+            if not self._checkpoints_enabled:
+                return
+            self._queue_checkpoint(MessageSendCheckpoint(
                 event_id=event_id,
                 room_id=room_id,
                 step=step,
@@ -313,11 +376,7 @@ class BaseMatrixHandler:
                 event_type=EventType.ROOM_MESSAGE,
                 message_type=message.msgtype,
                 info=error_text
-            ).send(
-                self.log,
-                self.bridge.config["homeserver.message_send_checkpoint_endpoint"],
-                self.az.as_token,
-            )
+            ))
 
         sender = await self.bridge.get_user(user_id)
         if not sender or not await self.allow_message(sender):
@@ -356,13 +415,7 @@ class BaseMatrixHandler:
         is_management = has_two_members and bridge_bot_in_room
 
         if is_command or is_management:
-            try:
-                command, arguments = text.split(" ", 1)
-                args = arguments.split(" ")
-            except ValueError:
-                # Not enough values to unpack, i.e. no arguments
-                command = text
-                args = []
+            command, *args = text.split(" ")
 
             try:
                 await self.commands.handle(room_id, event_id, sender, command, args, message,
@@ -370,53 +423,70 @@ class BaseMatrixHandler:
             except Exception as e:
                 await bail(repr(e), step=MessageSendCheckpointStep.COMMAND)
             else:
-                await MessageSendCheckpoint(
-                    event_id=event_id,
-                    room_id=room_id,
-                    step=MessageSendCheckpointStep.COMMAND,
-                    timestamp=int(time.time() * 1000),
-                    status=MessageSendCheckpointStatus.SUCCESS,
-                    reported_by=MessageSendCheckpointReportedBy.BRIDGE,
-                    event_type=EventType.ROOM_MESSAGE,
-                    message_type=message.msgtype,
-                ).send(
-                    self.log,
-                    self.bridge.config["homeserver.message_send_checkpoint_endpoint"],
-                    self.az.as_token,
-                )
+                if self._checkpoints_enabled:
+                    self._queue_checkpoint(MessageSendCheckpoint(
+                        event_id=event_id,
+                        room_id=room_id,
+                        step=MessageSendCheckpointStep.COMMAND,
+                        timestamp=int(time.time() * 1000),
+                        status=MessageSendCheckpointStatus.SUCCESS,
+                        reported_by=MessageSendCheckpointReportedBy.BRIDGE,
+                        event_type=EventType.ROOM_MESSAGE,
+                        message_type=message.msgtype,
+                    ))
         else:
             await bail(
                 f"Ignoring event {event_id} from {sender.mxid}: not a command and not a portal room"
             )
 
     async def _is_direct_chat(self, room_id: RoomID) -> Tuple[bool, bool]:
+        try:
+            cached_at, result = self._dm_cache[room_id]
+        except KeyError:
+            pass
+        else:
+            if cached_at + self._DM_CACHE_TTL > time.monotonic():
+                return result
         try:
             members = await self.az.intent.get_room_members(room_id)
-            return len(members) == 2, self.az.bot_mxid in members
         except MatrixError:
             return False, False
+        result = len(members) == 2, self.az.bot_mxid in members
+        self._dm_cache[room_id] = (time.monotonic(), result)
+        return result
 
     async def handle_receipt(self, evt: ReceiptEvent) -> None:
-        for event_id, receipts in evt.content.items():
-            for user_id, data in receipts[ReceiptType.READ].items():
-                user = await self.bridge.get_user(user_id, create=False)
-                if not user or not await user.is_logged_in():
-                    continue
+        tasks = [self._handle_user_receipt(evt.room_id, event_id, user_id, data)
+                 for event_id, receipts in evt.content.items()
+                 for user_id, data in receipts[ReceiptType.READ].items()]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.log.error("Error handling read receipt in %s", evt.room_id,
+                               exc_info=result)
+
+    async def _handle_user_receipt(self, room_id: RoomID, event_id: EventID, user_id: UserID,
+                                   data: SingleReceiptEventContent) -> None:
+        user = await self.bridge.get_user(user_id, create=False)
+        if not user or not await user.is_logged_in():
+            return
 
-                portal = await self.bridge.get_portal(evt.room_id)
-                if not portal:
-                    continue
+        portal = await self.bridge.get_portal(room_id)
+        if not portal:
+            return
 
-                await self.handle_read_receipt(user, portal, event_id, data)
+        await self.handle_read_receipt(user, portal, event_id, data)
 
     async def handle_read_receipt(self, user: 'BaseUser', portal: 'BasePortal', event_id: EventID,
                                   data: SingleReceiptEventContent) -> None:
         pass
 
     def filter_matrix_event(self, evt: Event) -> bool:
-        if not isinstance(evt, (MessageEvent, StateEvent, ReceiptEvent)):
+        """Called by :meth:`int_handle_event` for every event. Return ``True`` to ignore it."""
+        # Not all event types have a sender, e.g. typing notifications
+        if getattr(evt, "sender", None) != self._bot_mxid:
             return False
-        return evt.sender == self.az.bot_mxid
+        return isinstance(evt, (MessageEvent, StateEvent, ReceiptEvent))
 
     async def try_handle_sync_event(self, evt: Event) -> None:
         try:
@@ -493,6 +563,7 @@ class BaseMatrixHandler:
         await self.az.intent.send_message(evt.room_id, content)
 
     async def handle_encryption(self, evt: StateEvent) -> None:
+        self._dm_cache.pop(evt.room_id, None)
         await self.az.state_store.set_encryption_info(evt.room_id, evt.content)
         portal = await self.bridge.get_portal(evt.room_id)
         if portal:
@@ -503,17 +574,20 @@ class BaseMatrixHandler:
                 await portal.enable_dm_encryption()
 
     async def send_message_send_checkpoint(self, evt: Event):
-        if not self.bridge.config["homeserver.message_send_checkpoint_endpoint"]:
+        self._queue_bridge_checkpoint(evt)
+
+    def _queue_bridge_checkpoint(self, evt: Event) -> None:
+        if not self._checkpoints_enabled:
             return
-        if evt.type not in CHECKPOINT_TYPES:
+        if not is_checkpoint_type(evt.type):
             return
         # Exclude encrypted events because they will be decrypted and handled as normal events.
         if evt.type == EventType.ROOM_ENCRYPTED:
             return
 
-        self.log.debug(f"Sending message send checkpoint for {evt.event_id} to API server.")
+        self.log.debug(f"Queueing message send checkpoint for {evt.event_id} to API server.")
 
-        await MessageSendCheckpoint(
+        self._queue_checkpoint(MessageSendCheckpoint(
             event_id=evt.event_id,
             room_id=evt.room_id,
             step=MessageSendCheckpointStep.BRIDGE,
@@ -522,74 +596,93 @@ class BaseMatrixHandler:
             reported_by=MessageSendCheckpointReportedBy.BRIDGE,
             event_type=evt.type,
             message_type=evt.content.msgtype if evt.type == EventType.ROOM_MESSAGE else None,
-        ).send(
-            self.log,
-            self.bridge.config["homeserver.message_send_checkpoint_endpoint"],
-            self.az.as_token,
-        )
+        ))
+
+    def _queue_checkpoint(self, checkpoint: MessageSendCheckpoint) -> None:
+        if not self._checkpoints_enabled:
+            return
+        CheckpointSender.instance(self._checkpoint_endpoint, self.az.as_token,
+                                  self.log).enqueue(checkpoint)
+
+    async def _dispatch_member(self, evt: StateEvent) -> None:
+        unsigned = evt.unsigned or _EMPTY_UNSIGNED
+        prev_content = unsigned.prev_content or _EMPTY_MEMBER_CONTENT
+        prev_membership = prev_content.membership if prev_content else Membership.JOIN
+        if evt.content.membership == Membership.INVITE:
+            await self.int_handle_invite(evt.room_id, UserID(evt.state_key), evt.sender,
+                                         evt.event_id)
+        elif evt.content.membership == Membership.LEAVE:
+            if prev_membership == Membership.BAN:
+                await self.handle_unban(evt.room_id, UserID(evt.state_key), evt.sender,
+                                        evt.content.reason, evt.event_id)
+            elif prev_membership == Membership.INVITE:
+                if evt.sender == evt.state_key:
+                    await self.handle_reject(evt.room_id, UserID(evt.state_key),
+                                             evt.content.reason, evt.event_id)
+                else:
+                    await self.handle_disinvite(evt.room_id, UserID(evt.state_key), evt.sender,
+                                                evt.content.reason, evt.event_id)
+            elif evt.sender == evt.state_key:
+                await self.handle_leave(evt.room_id, UserID(evt.state_key), evt.event_id)
+            else:
+                await self.handle_kick(evt.room_id, UserID(evt.state_key), evt.sender,
+                                       evt.content.reason, evt.event_id)
+        elif evt.content.membership == Membership.BAN:
+            await self.handle_ban(evt.room_id, UserID(evt.state_key), evt.sender,
+                                  evt.content.reason, evt.event_id)
+        elif evt.content.membership == Membership.JOIN:
+            if prev_membership != Membership.JOIN:
+                await self.handle_join(evt.room_id, UserID(evt.state_key), evt.event_id)
+            else:
+                await self.handle_member_info_change(evt.room_id, UserID(evt.state_key),
+                                                     evt.content, prev_content, evt.event_id)
+
+    async def _dispatch_message(self, evt: MessageEvent) -> None:
+        if evt.type == EventType.STICKER:
+            evt.content.msgtype = MessageType.STICKER
+        await self.handle_message(evt.room_id, evt.sender, evt.content, evt.event_id)
+
+    async def _dispatch_other(self, evt: Event) -> None:
+        if evt.type.is_state and isinstance(evt, StateEvent):
+            await self.handle_state_event(evt)
+        elif evt.type.is_ephemeral and isinstance(evt, (PresenceEvent, TypingEvent,
+                                                        ReceiptEvent)):
+            await self.handle_ephemeral_event(evt)
+        else:
+            await self.handle_event(evt)
 
     async def int_handle_event(self, evt: Event) -> None:
-        if isinstance(evt, StateEvent) and evt.type == EventType.ROOM_MEMBER and self.e2ee:
-            await self.e2ee.handle_member_event(evt)
+        if evt.type == EventType.ROOM_MEMBER:
+            # Membership changed, so the cached direct chat status may be stale
+            self._dm_cache.pop(evt.room_id, None)
+            # This must happen before filtering out the bridge bot's own events: the bot inviting
+            # or kicking real users still has to invalidate the outbound group session.
+            # Ghost membership changes are already skipped inside handle_member_event.
+            if self.e2ee and isinstance(evt, StateEvent):
+                await self.e2ee.handle_member_event(evt)
         if self.filter_matrix_event(evt):
             return
         self.log.trace("Received event: %s", evt)
-        start_time = time.time()
+        start_time = time.monotonic()
 
-        asyncio.create_task(self.send_message_send_checkpoint(evt))
+        if self._checkpoint_overridden:
+            # Overrides may do I/O or raise, so keep them out of the event handling path.
+            asyncio.create_task(self.send_message_send_checkpoint(evt))
+        elif self._checkpoints_enabled and evt.type in BRIDGE_CHECKPOINT_TYPES:
+            try:
+                self._queue_bridge_checkpoint(evt)
+            except Exception:
+                self.log.exception(f"Failed to queue message send checkpoint for {evt.event_id}")
 
-        if evt.type == EventType.ROOM_MEMBER:
-            evt: StateEvent
-            unsigned = evt.unsigned or StateUnsigned()
-            prev_content = unsigned.prev_content or MemberStateEventContent()
-            prev_membership = prev_content.membership if prev_content else Membership.JOIN
-            if evt.content.membership == Membership.INVITE:
-                await self.int_handle_invite(evt.room_id, UserID(evt.state_key), evt.sender,
-                                             evt.event_id)
-            elif evt.content.membership == Membership.LEAVE:
-                if prev_membership == Membership.BAN:
-                    await self.handle_unban(evt.room_id, UserID(evt.state_key), evt.sender,
-                                            evt.content.reason, evt.event_id)
-                elif prev_membership == Membership.INVITE:
-                    if evt.sender == evt.state_key:
-                        await self.handle_reject(evt.room_id, UserID(evt.state_key),
-                                                 evt.content.reason, evt.event_id)
-                    else:
-                        await self.handle_disinvite(evt.room_id, UserID(evt.state_key), evt.sender,
-                                                    evt.content.reason, evt.event_id)
-                elif evt.sender == evt.state_key:
-                    await self.handle_leave(evt.room_id, UserID(evt.state_key), evt.event_id)
-                else:
-                    await self.handle_kick(evt.room_id, UserID(evt.state_key), evt.sender,
-                                           evt.content.reason, evt.event_id)
-            elif evt.content.membership == Membership.BAN:
-                await self.handle_ban(evt.room_id, UserID(evt.state_key), evt.sender,
-                                      evt.content.reason, evt.event_id)
-            elif evt.content.membership == Membership.JOIN:
-                if prev_membership != Membership.JOIN:
-                    await self.handle_join(evt.room_id, UserID(evt.state_key), evt.event_id)
-                else:
-                    await self.handle_member_info_change(evt.room_id, UserID(evt.state_key),
-                                                         evt.content, prev_content, evt.event_id)
-        elif evt.type in (EventType.ROOM_MESSAGE, EventType.STICKER):
-            evt: MessageEvent
-            if evt.type != EventType.ROOM_MESSAGE:
-                evt.content.msgtype = MessageType(str(evt.type))
-            await self.handle_message(evt.room_id, evt.sender, evt.content, evt.event_id)
-        elif evt.type == EventType.ROOM_ENCRYPTED:
-            await self.handle_encrypted(evt)
-        elif evt.type == EventType.ROOM_ENCRYPTION:
-            await self.handle_encryption(evt)
-        else:
-            if evt.type.is_state and isinstance(evt, StateEvent):
-                await self.handle_state_event(evt)
-            elif evt.type.is_ephemeral and isinstance(evt, (PresenceEvent, TypingEvent,
-                                                            ReceiptEvent)):
-                await self.handle_ephemeral_event(evt)
-            else:
-                await self.handle_event(evt)
+        handler = self._dispatch.get(evt.type, self._dispatch_other)
+        await handler(evt)
 
-        await self.log_event_handle_duration(evt, time.time() - start_time)
+        await self.log_event_handle_duration(evt, time.monotonic() - start_time)
 
     async def log_event_handle_duration(self, evt: Event, duration: float) -> None:
-        EVENT_TIME.labels(event_type=str(evt.type)).observe(duration)
+        try:
+            histogram = self._event_time_labels[evt.type]
+        except KeyError:
+            histogram = self._event_time_labels[evt.type] = EVENT_TIME.labels(
+                event_type=str(evt.type))
+        histogram.observe(duration)
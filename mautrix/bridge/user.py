@@ -156,28 +156,26 @@ class BaseUser(ABC):
         error: Optional[Exception] = None,
     ) -> Optional[asyncio.Task]:
         """
-        Send a remote checkpoint for the given ``event_id``. This function spaws an
-        :class:`asyncio.Task`` to send the checkpoint.
+        Send a remote checkpoint for the given ``event_id``. This function spawns an
+        :class:`asyncio.Task` to send the checkpoint.
 
         :returns: the checkpoint send task. This can be awaited if you want to block on the
         checkpoint send.
         """
         if not self.bridge.config["homeserver.message_send_checkpoint_endpoint"]:
             return None
-        return asyncio.create_task(
-            MessageSendCheckpoint(
-                event_id=event_id,
-                room_id=room_id,
-                step=MessageSendCheckpointStep.REMOTE,
-                timestamp=int(time.time() * 1000),
-                status=status,
-                reported_by=MessageSendCheckpointReportedBy.BRIDGE,
-                event_type=event_type,
-                message_type=message_type,
-                info=str(error) if error else None,
-            ).send(
-                self.log,
-                self.bridge.config["homeserver.message_send_checkpoint_endpoint"],
-                self.az.as_token,
-            )
+        return MessageSendCheckpoint(
+            event_id=event_id,
+            room_id=room_id,
+            step=MessageSendCheckpointStep.REMOTE,
+            timestamp=int(time.time() * 1000),
+            status=status,
+            reported_by=MessageSendCheckpointReportedBy.BRIDGE,
+            event_type=event_type,
+            message_type=message_type,
+            info=str(error) if error else None,
+        ).send_nowait(
+            self.log,
+            self.bridge.config["homeserver.message_send_checkpoint_endpoint"],
+            self.az.as_token,
         )
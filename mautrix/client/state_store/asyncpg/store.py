@@ -31,7 +31,7 @@ class PgStateStore(StateStore):
     async def get_member(self, room_id: RoomID, user_id: UserID) -> Optional[Member]:
         res = await self.db.fetchrow("SELECT membership, displayname, avatar_url "
                                      "FROM mx_user_profile WHERE room_id=$1 AND user_id=$2",
-                                     room_id, user_id)
+                                     room_id, user_id, readonly=True)
         if res is None:
             return None
         return Member(membership=Membership.deserialize(res["membership"]),
@@ -55,7 +55,7 @@ class PgStateStore(StateStore):
     async def get_members(self, room_id: RoomID) -> Optional[List[UserID]]:
         res = await self.db.fetch("SELECT user_id FROM mx_user_profile "
                                   "WHERE room_id=$1 AND (membership='join' OR membership='invite')",
-                                  room_id)
+                                  room_id, readonly=True)
         return [profile["user_id"] for profile in res]
 
     async def get_members_filtered(self, room_id: RoomID, not_prefix: str, not_suffix: str,
@@ -63,7 +63,7 @@ class PgStateStore(StateStore):
         res = await self.db.fetch("SELECT user_id FROM mx_user_profile "
                                   "WHERE room_id=$1 AND (membership='join' OR membership='invite')"
                                   "AND user_id != $2 AND user_id NOT LIKE $3",
-                                  room_id, not_id, f"{not_prefix}%{not_suffix}")
+                                  room_id, not_id, f"{not_prefix}%{not_suffix}", readonly=True)
         return [profile["user_id"] for profile in res]
 
     async def set_members(self, room_id: RoomID,
@@ -98,15 +98,15 @@ class PgStateStore(StateStore):
 
     async def has_full_member_list(self, room_id: RoomID) -> bool:
         return bool(await self.db.fetchval("SELECT has_full_member_list FROM mx_room_state "
-                                           "WHERE room_id=$1", room_id))
+                                           "WHERE room_id=$1", room_id, readonly=True))
 
     async def has_power_levels_cached(self, room_id: RoomID) -> bool:
         return bool(await self.db.fetchval("SELECT power_levels IS NOT NULL FROM mx_room_state "
-                                           "WHERE room_id=$1", room_id))
+                                           "WHERE room_id=$1", room_id, readonly=True))
 
     async def get_power_levels(self, room_id: RoomID) -> Optional[PowerLevelStateEventContent]:
         power_levels_json = await self.db.fetchval("SELECT power_levels FROM mx_room_state "
-                                                   "WHERE room_id=$1", room_id)
+                                                   "WHERE room_id=$1", room_id, readonly=True)
         if power_levels_json is None:
             return None
         return PowerLevelStateEventContent.parse_json(power_levels_json)
@@ -118,16 +118,16 @@ class PgStateStore(StateStore):
 
     async def has_encryption_info_cached(self, room_id: RoomID) -> bool:
         return bool(await self.db.fetchval("SELECT encryption IS NULL FROM mx_room_state "
-                                           "WHERE room_id=$1", room_id))
+                                           "WHERE room_id=$1", room_id, readonly=True))
 
     async def is_encrypted(self, room_id: RoomID) -> Optional[bool]:
         return await self.db.fetchval("SELECT is_encrypted FROM mx_room_state WHERE room_id=$1",
-                                      room_id)
+                                      room_id, readonly=True)
 
     async def get_encryption_info(self, room_id: RoomID
                                   ) -> Optional[RoomEncryptionStateEventContent]:
         row = await self.db.fetchrow("SELECT is_encrypted, encryption FROM mx_room_state "
-                                     "WHERE room_id=$1", room_id)
+                                     "WHERE room_id=$1", room_id, readonly=True)
         if row is None or not row["is_encrypted"]:
             return None
         return RoomEncryptionStateEventContent.parse_json(row["encryption"])
@@ -3,9 +3,10 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
-from typing import Optional, Dict, Any, List
-from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Deque, Iterable, Sequence
+from collections import deque
 from urllib.parse import urlparse
+import pathlib
 import asyncio
 import logging
 import sqlite3
@@ -16,51 +17,217 @@ from .upgrade import UpgradeTable
 from .database import Database
 
 
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -64000,
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+# The default SQLITE_MAX_VARIABLE_NUMBER in SQLite versions before 3.32
+MAX_VARIABLES = 999
+
+# db_args keys that configure SQLiteDatabase itself rather than individual connections
+POOL_ARGS = ("min_size", "max_size", "read_only_size")
+
+
+def _quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
 class TxnConnection(aiosqlite.Connection):
-    def __init__(self, path: str, **kwargs) -> None:
+    def __init__(self, path: str, pragmas: Optional[Dict[str, Any]] = None,
+                 read_only: bool = False, **kwargs) -> None:
+        pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        # The sqlite3 module keeps an LRU cache of prepared statements keyed by the query string
+        kwargs.setdefault("cached_statements", 256)
+        # Declared type conversion is kept by default, as existing schemas may rely on the
+        # built-in timestamp and date converters. Databases that don't can pass
+        # detect_types=0 in db_args to skip the converter lookup for every column.
+        kwargs.setdefault("detect_types", sqlite3.PARSE_DECLTYPES)
+        # All calls happen on aiosqlite's worker thread anyway.
+        kwargs.setdefault("check_same_thread", False)
+        if read_only:
+            path = f"{pathlib.Path(path).absolute().as_uri()}?mode=ro"
+            kwargs["uri"] = True
+
         def connector() -> sqlite3.Connection:
-            return sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES,
-                                   isolation_level=None, **kwargs)
+            # isolation_level=None disables the implicit transactions, transaction() uses
+            # explicit BEGINs instead.
+            conn = sqlite3.connect(path, isolation_level=None, **kwargs)
+            conn.row_factory = sqlite3.Row
+            for key, value in pragmas.items():
+                conn.execute(f"PRAGMA {key}={value}")
+            return conn
 
         super().__init__(connector, iter_chunk_size=64)
 
-    @asynccontextmanager
-    async def transaction(self) -> None:
-        await self.execute("BEGIN TRANSACTION")
-        try:
-            yield
-        except Exception:
-            await self.rollback()
-            raise
-        else:
-            await self.commit()
+    def transaction(self, *, immediate: bool = True) -> '_Transaction':
+        """
+        Start a transaction. By default, the write lock is taken immediately, so the transaction
+        can't fail with SQLITE_BUSY halfway through when upgrading from a read lock. Pass
+        ``immediate=False`` for transactions that only read.
+        """
+        return _Transaction(self, immediate)
 
     async def execute(self, query: str, *args: Any, timeout: Optional[float] = None) -> None:
         await super().execute(query, args)
 
+    async def executemany(self, query: str, args: Iterable[Sequence[Any]],
+                          timeout: Optional[float] = None) -> None:
+        """
+        Execute the query once for every item in ``args`` in a single call to the worker thread.
+        The statements are wrapped in a transaction unless one is already open.
+        """
+        if self.in_transaction:
+            await super().executemany(query, args)
+        else:
+            async with self.transaction():
+                await super().executemany(query, args)
+
+    async def copy_records_to_table(self, table_name: str, *, records: Iterable[Sequence[Any]],
+                                    columns: Optional[Sequence[str]] = None,
+                                    schema_name: Optional[str] = None,
+                                    timeout: Optional[float] = None) -> None:
+        """
+        Insert many rows into a table, like the asyncpg method with the same name. The rows are
+        inserted with multi-row ``INSERT`` statements that stay under SQLite's parameter limit.
+        """
+        records = list(records)
+        if not records:
+            return
+        width = len(columns) if columns else len(records[0])
+        table = _quote_ident(table_name)
+        if schema_name:
+            table = f"{_quote_ident(schema_name)}.{table}"
+        column_list = f" ({', '.join(_quote_ident(col) for col in columns)})" if columns else ""
+        row_placeholder = f"({', '.join('?' * width)})"
+        chunk_size = max(MAX_VARIABLES // width, 1)
+
+        async def insert() -> None:
+            for i in range(0, len(records), chunk_size):
+                chunk = records[i:i + chunk_size]
+                values = ", ".join([row_placeholder] * len(chunk))
+                await self.execute(f"INSERT INTO {table}{column_list} VALUES {values}",
+                                   *(value for record in chunk for value in record))
+
+        if self.in_transaction:
+            await insert()
+        else:
+            async with self.transaction():
+                await insert()
+
     async def fetch(self, query: str, *args: Any, timeout: Optional[float] = None
                     ) -> List[sqlite3.Row]:
         async with super().execute(query, args) as cursor:
-            return list(await cursor.fetchall())
+            # sqlite3's fetchall already returns a list, aiosqlite just annotates it as Iterable
+            return await cursor.fetchall()
 
     async def fetchrow(self, query: str, *args: Any, timeout: Optional[float] = None
                        ) -> sqlite3.Row:
-        async with super().execute(query, args) as cursor:
+        cursor = await super().execute(query, args)
+        try:
             return await cursor.fetchone()
+        finally:
+            await cursor.close()
 
     async def fetchval(self, query: str, *args: Any, column: int = 0,
                        timeout: Optional[float] = None) -> Any:
-        row = await self.fetchrow(query, *args)
+        cursor = await super().execute(query, args)
+        try:
+            row = await cursor.fetchone()
+        finally:
+            await cursor.close()
         if row is None:
             return None
         return row[column]
 
 
+class _Transaction:
+    __slots__ = ("_conn", "_immediate")
+
+    def __init__(self, conn: TxnConnection, immediate: bool) -> None:
+        self._conn = conn
+        self._immediate = immediate
+
+    async def __aenter__(self) -> None:
+        await self._conn.execute("BEGIN IMMEDIATE" if self._immediate else "BEGIN DEFERRED")
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            await self._conn.commit()
+        else:
+            # This includes cancellation, otherwise the connection would go back to the pool
+            # with the transaction (and the write lock) still open.
+            await self._conn.rollback()
+
+
+class _ConnectionPool:
+    """
+    A minimal connection pool: a stack of idle connections and a FIFO of futures waiting for one.
+    Returned connections are handed directly to the first waiter.
+    """
+    maxsize: int
+    _idle: List[TxnConnection]
+    _waiters: Deque['asyncio.Future[TxnConnection]']
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._idle = []
+        self._waiters = deque()
+
+    async def get(self) -> TxnConnection:
+        if self._idle:
+            return self._idle.pop()
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # The connection was already handed to us, give it to someone else
+                self.put_nowait(fut.result())
+            else:
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+
+    def put_nowait(self, conn: TxnConnection) -> None:
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(conn)
+                return
+        self._idle.append(conn)
+
+
+class _PoolAcquire:
+    __slots__ = ("_pool", "_conn")
+
+    def __init__(self, pool: _ConnectionPool) -> None:
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self) -> TxnConnection:
+        self._conn = await self._pool.get()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self._pool.put_nowait(self._conn)
+        self._conn = None
+
+
 class SQLiteDatabase(Database):
     scheme = "sqlite"
-    _pool: 'asyncio.Queue[TxnConnection]'
+    _conn_args: Dict[str, Any]
+    _pool: _ConnectionPool
+    _ro_pool: Optional[_ConnectionPool]
     _stopped: bool
     _conns: int
+    _ro_conns: int
 
     def __init__(self, url: str, upgrade_table: UpgradeTable,
                  db_args: Optional[Dict[str, Any]] = None,
@@ -69,18 +236,43 @@ class SQLiteDatabase(Database):
         self._path = urlparse(url).path
         if self._path.startswith("/"):
             self._path = self._path[1:]
-        self._pool = asyncio.Queue(self._db_args.pop("min_size", 5))
-        self._db_args.pop("max_size", None)
+        min_size = self._db_args.get("min_size", 5)
+        # Read-only connections don't work for in-memory databases, as each connection
+        # would get its own database.
+        read_only_size = self._db_args.get("read_only_size", 0)
+        if read_only_size > 0 and self._path not in ("", ":memory:"):
+            self._pool = _ConnectionPool(max(min_size - read_only_size, 1))
+            self._ro_pool = _ConnectionPool(read_only_size)
+        else:
+            self._pool = _ConnectionPool(min_size)
+            self._ro_pool = None
+        self._conn_args = {key: value for key, value in self._db_args.items()
+                           if key not in POOL_ARGS}
+        self._conn_args["pragmas"] = {**DEFAULT_PRAGMAS, **self._db_args.get("pragmas", {})}
         self._stopped = False
         self._conns = 0
+        self._ro_conns = 0
 
     async def start(self) -> None:
         self.log.debug(f"Connecting to {self.url}")
-        for _ in range(self._pool.maxsize):
-            conn = await TxnConnection(self._path, **self._db_args)
-            conn.row_factory = sqlite3.Row
+        # The first connection is opened alone so that the database file exists and the journal
+        # mode has been switched before the rest of the connections (including the read-only
+        # ones) are opened concurrently.
+        self._pool.put_nowait(await TxnConnection(self._path, **self._conn_args))
+        self._conns += 1
+        ro_size = self._ro_pool.maxsize if self._ro_pool else 0
+        conns = await asyncio.gather(
+            *(TxnConnection(self._path, **self._conn_args)
+              for _ in range(self._pool.maxsize - 1)),
+            *(TxnConnection(self._path, read_only=True, **self._conn_args)
+              for _ in range(ro_size)),
+        )
+        for conn in conns[:self._pool.maxsize - 1]:
             self._pool.put_nowait(conn)
             self._conns += 1
+        for conn in conns[self._pool.maxsize - 1:]:
+            self._ro_pool.put_nowait(conn)
+            self._ro_conns += 1
         await super().start()
 
     async def stop(self) -> None:
@@ -89,16 +281,25 @@ class SQLiteDatabase(Database):
             conn = await self._pool.get()
             self._conns -= 1
             await conn.close()
+        while self._ro_conns > 0:
+            conn = await self._ro_pool.get()
+            self._ro_conns -= 1
+            await conn.close()
+
+    def acquire(self, readonly: bool = False) -> _PoolAcquire:
+        """
+        Acquire a connection from the pool.
 
-    @asynccontextmanager
-    async def acquire(self) -> TxnConnection:
+        :param readonly: Whether the connection will only be used for reading. If
+                         ``read_only_size`` is set in the database args, these use a separate
+                         pool of read-only connections that don't have to wait for writers.
+                         The :class:`Database` shortcuts like :meth:`fetchval` only use it when
+                         called with ``readonly=True``, as they are also used for ``UPDATE``
+                         and ``INSERT`` queries.
+        """
         if self._stopped:
             raise RuntimeError("database pool has been stopped")
-        conn = await self._pool.get()
-        try:
-            yield conn
-        finally:
-            self._pool.put_nowait(conn)
+        return _PoolAcquire(self._ro_pool if readonly and self._ro_pool else self._pool)
 
 
 Database.schemes["sqlite"] = SQLiteDatabase
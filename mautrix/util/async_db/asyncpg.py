@@ -49,7 +49,7 @@ class PostgresDatabase(Database):
         if not self._pool_override:
             await self.pool.close()
 
-    def acquire(self) -> 'AcquireResult':
+    def acquire(self, readonly: bool = False) -> 'AcquireResult':
         return self.pool.acquire()
 
 
@@ -3,7 +3,8 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
-from typing import Any, List, Awaitable, Type, Dict, Union, Optional, TYPE_CHECKING
+from typing import (Any, List, Awaitable, Type, Dict, Union, Optional, Iterable, Sequence,
+                    TYPE_CHECKING)
 from abc import ABC, abstractmethod
 from urllib.parse import urlparse
 import logging
@@ -80,23 +81,36 @@ class Database(ABC):
         pass
 
     @abstractmethod
-    def acquire(self) -> 'AcquireResult':
+    def acquire(self, readonly: bool = False) -> 'AcquireResult':
+        """
+        Acquire a connection from the pool.
+
+        :param readonly: A hint that the connection will only be used for reading. Backends
+                         that have a separate pool for reads (like SQLite with
+                         ``read_only_size``) will use it, others ignore the hint.
+        """
         pass
 
     async def execute(self, query: str, *args: Any, timeout: Optional[float] = None) -> str:
         async with self.acquire() as conn:
             return await conn.execute(query, *args, timeout=timeout)
 
-    async def fetch(self, query: str, *args: Any, timeout: Optional[float] = None
-                    ) -> List['Record']:
+    async def executemany(self, query: str, args: Iterable[Sequence[Any]],
+                          timeout: Optional[float] = None) -> None:
         async with self.acquire() as conn:
+            await conn.executemany(query, args, timeout=timeout)
+
+    async def fetch(self, query: str, *args: Any, timeout: Optional[float] = None,
+                    readonly: bool = False) -> List['Record']:
+        async with self.acquire(readonly=readonly) as conn:
             return await conn.fetch(query, *args, timeout=timeout)
 
     async def fetchval(self, query: str, *args: Any, column: int = 0,
-                       timeout: Optional[float] = None) -> Any:
-        async with self.acquire() as conn:
+                       timeout: Optional[float] = None, readonly: bool = False) -> Any:
+        async with self.acquire(readonly=readonly) as conn:
             return await conn.fetchval(query, *args, column=column, timeout=timeout)
 
-    async def fetchrow(self, query: str, *args: Any, timeout: Optional[float] = None) -> 'Record':
-        async with self.acquire() as conn:
+    async def fetchrow(self, query: str, *args: Any, timeout: Optional[float] = None,
+                       readonly: bool = False) -> 'Record':
+        async with self.acquire(readonly=readonly) as conn:
             return await conn.fetchrow(query, *args, timeout=timeout)
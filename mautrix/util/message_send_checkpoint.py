@@ -1,11 +1,21 @@
 import logging
-from typing import Optional
+import asyncio
+import functools
+import json
+from typing import Optional, Dict, List, Tuple, ClassVar, Mapping, FrozenSet, Set
+from types import MappingProxyType
 from attr import dataclass
 
 import aiohttp
 from aiohttp.client import ClientTimeout
+from yarl import URL
 
-from mautrix.types import EventType, MessageType, SerializableEnum, SerializableAttrs
+from mautrix.types import EventType, MessageType, SerializableEnum, SerializableAttrs, JSON
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class MessageSendCheckpointStep(SerializableEnum):
@@ -40,31 +50,201 @@ class MessageSendCheckpoint(SerializableAttrs):
     message_type: Optional[MessageType] = None
     info: Optional[str] = None
 
+    def serialize(self) -> JSON:
+        # The generic attrs serializer is slow, and the fields here are fixed
+        data = {
+            "event_id": self.event_id,
+            "room_id": self.room_id,
+            "step": self.step.value,
+            "timestamp": self.timestamp,
+            "status": self.status.value,
+            "event_type": self.event_type.serialize(),
+            "reported_by": self.reported_by.value,
+            "retry_num": self.retry_num,
+        }
+        if self.message_type is not None:
+            data["message_type"] = self.message_type.value
+        if self.info is not None:
+            data["info"] = self.info
+        return data
+
     async def send(self, log: logging.Logger, endpoint: str, as_token: str) -> None:
         if not endpoint:
             return
+        await CheckpointSender.instance(endpoint, as_token, log).enqueue(self)
+
+    def send_nowait(self, log: logging.Logger, endpoint: str, as_token: str) -> asyncio.Task:
+        """
+        Send the checkpoint in a background task.
+
+        :returns: the send task. This can be awaited if you want to block on the checkpoint send.
+        """
+        task = asyncio.create_task(self.send(log, endpoint, as_token))
+        # The event loop only keeps weak references to tasks, so hold on to it until it's done.
+        _pending.add(task)
+        task.add_done_callback(_pending.discard)
+        return task
+
+
+class CheckpointSender:
+    """
+    Collects message send checkpoints for one endpoint and sends them in batches from a
+    background task.
+    """
+    max_batch_size: ClassVar[int] = 32
+    max_delay: ClassVar[float] = 0.05
+    _instances: ClassVar[Dict[Tuple[str, str], 'CheckpointSender']] = {}
+
+    endpoint: str
+    as_token: str
+    log: logging.Logger
+    # None is used as a sentinel to stop the flush loop
+    _queue: 'asyncio.Queue[Optional[Tuple[MessageSendCheckpoint, asyncio.Future]]]'
+    _task: Optional[asyncio.Task]
+
+    def __init__(self, endpoint: str, as_token: str, log: Optional[logging.Logger] = None
+                 ) -> None:
+        self.endpoint = endpoint
+        self.as_token = as_token
+        self.log = log or logging.getLogger("mau.checkpoint")
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    @classmethod
+    def instance(cls, endpoint: str, as_token: str, log: Optional[logging.Logger] = None
+                 ) -> 'CheckpointSender':
         try:
-            headers = {"Authorization": f"Bearer {as_token}"}
-            async with aiohttp.ClientSession() as sess, sess.post(
-                endpoint,
-                json={"checkpoints": [self.serialize()]},
-                headers=headers,
-                timeout=ClientTimeout(5),
-            ) as resp:
-                if not 200 <= resp.status < 300:
-                    text = await resp.text()
-                    text = text.replace("\n", "\\n")
-                    log.warning(
-                        f"Unexpected status code {resp.status} sending message send checkpoints"
-                        f" for {self.event_id}: {text}"
-                    )
-                else:
-                    log.info(f"Successfully sent message send checkpoints for {self.event_id}")
-        except Exception as e:
-            log.warning(f"Failed to send message send checkpoints for {self.event_id}: {e}")
-
-
-CHECKPOINT_TYPES = {
+            return cls._instances[endpoint, as_token]
+        except KeyError:
+            sender = cls._instances[endpoint, as_token] = cls(endpoint, as_token, log)
+            return sender
+
+    @classmethod
+    async def stop_all(cls) -> None:
+        senders = list(cls._instances.values())
+        cls._instances.clear()
+        await asyncio.gather(*(sender.stop() for sender in senders))
+
+    def enqueue(self, checkpoint: MessageSendCheckpoint) -> 'asyncio.Future[None]':
+        """
+        Queue a checkpoint to be sent in the next batch.
+
+        :returns: a future that completes after the batch containing the checkpoint was sent.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((checkpoint, fut))
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+        return fut
+
+    async def stop(self) -> None:
+        """Send all queued checkpoints and stop the background task."""
+        if self._task:
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+
+    async def _flush_loop(self) -> None:
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            if self._queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._send_batch(batch)
+
+    async def _send_batch(self, batch: List[Tuple[MessageSendCheckpoint, asyncio.Future]]
+                          ) -> None:
+        try:
+            await send_message_send_checkpoints([checkpoint for checkpoint, _ in batch],
+                                                self.log, self.endpoint, self.as_token)
+        finally:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_result(None)
+
+
+_session: Optional[aiohttp.ClientSession] = None
+_pending: Set[asyncio.Task] = set()
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=75)
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def close_checkpoint_session() -> None:
+    global _session
+    if _pending:
+        await asyncio.gather(*_pending)
+    await CheckpointSender.stop_all()
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+_TIMEOUT = ClientTimeout(5)
+
+
+# The cached values are shared between requests, so the headers are returned as a read-only view
+@functools.lru_cache(maxsize=8)
+def _headers(as_token: str) -> Mapping[str, str]:
+    return MappingProxyType({
+        "Authorization": f"Bearer {as_token}",
+        "Content-Type": "application/json",
+    })
+
+
+def _dumps(data: JSON) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode("utf-8")
+
+
+@functools.lru_cache(maxsize=8)
+def _url(endpoint: str) -> URL:
+    return URL(endpoint)
+
+
+async def send_message_send_checkpoints(checkpoints: List[MessageSendCheckpoint],
+                                        log: logging.Logger, endpoint: str, as_token: str
+                                        ) -> None:
+    if not endpoint or not checkpoints:
+        return
+    event_ids = ", ".join(checkpoint.event_id for checkpoint in checkpoints)
+    try:
+        data = {"checkpoints": [checkpoint.serialize() for checkpoint in checkpoints]}
+        await _post(_get_session(), log, _url(endpoint), _headers(as_token), data, event_ids)
+    except Exception as e:
+        log.warning(f"Failed to send message send checkpoints for {event_ids}: {e}")
+
+
+async def _post(sess: aiohttp.ClientSession, log: logging.Logger, endpoint: URL,
+                headers: Mapping[str, str], data: JSON, event_ids: str) -> None:
+    async with sess.post(endpoint, data=_dumps(data), headers=headers, timeout=_TIMEOUT) as resp:
+        if not 200 <= resp.status < 300:
+            text = await resp.text()
+            text = text.replace("\n", "\\n")
+            log.warning(
+                f"Unexpected status code {resp.status} sending message send checkpoints"
+                f" for {event_ids}: {text}"
+            )
+        else:
+            log.info(f"Successfully sent message send checkpoints for {event_ids}")
+
+
+CHECKPOINT_TYPES: FrozenSet[EventType] = frozenset({
     EventType.ROOM_REDACTION,
     EventType.ROOM_MESSAGE,
     EventType.ROOM_ENCRYPTED,
@@ -77,4 +257,11 @@ CHECKPOINT_TYPES = {
     EventType.CALL_HANGUP,
     EventType.CALL_REJECT,
     EventType.CALL_NEGOTIATE,
-}
+})
+# The raw type strings, for callers that only have the string and not an EventType with a class.
+CHECKPOINT_TYPE_VALUES: FrozenSet[str] = frozenset(evt_type.t for evt_type in CHECKPOINT_TYPES)
+
+
+def is_checkpoint_type(evt_type: EventType) -> bool:
+    """Check whether message send checkpoints should be sent for events of the given type."""
+    return evt_type in CHECKPOINT_TYPES